@@ -7,17 +7,86 @@ import os
 
 import nltk
 import re
-nltk.download('punkt')
-nltk.download('averaged_perceptron_tagger')
-nltk.download('maxent_ne_chunker')
-nltk.download('words')
+from functools import lru_cache
+from itertools import chain
+
+
+def _ensure_nltk_data(
+    resource: str,
+    package: str
+) -> None:
+    """Download an NLTK package only if its resource cannot be found."""
+    try:
+        nltk.data.find(resource)
+    except LookupError:
+        nltk.download(package)
+
+
+def _has_tab_tokenizer() -> bool:
+    """Whether the installed NLTK tokenizes with the pickle-free punkt_tab resource."""
+    try:
+        from nltk.tokenize import PunktTokenizer
+    except ImportError:
+        return False
+    return True
+
+
+def _has_tab_chunker() -> bool:
+    """Whether the installed NLTK (>=3.9) loads the tagger and the chunker from the pickle-free resources."""
+    try:
+        from nltk.chunk import ne_chunker
+    except ImportError:
+        return False
+    return True
+
+
+def download_nltk_data() -> None:
+    """Download the NLTK data needed by the nltk engine for the installed NLTK release."""
+    if _has_tab_tokenizer():
+        _ensure_nltk_data('tokenizers/punkt_tab', 'punkt_tab')
+    else:
+        _ensure_nltk_data('tokenizers/punkt', 'punkt')
+    if _has_tab_chunker():
+        _ensure_nltk_data('taggers/averaged_perceptron_tagger_eng', 'averaged_perceptron_tagger_eng')
+        _ensure_nltk_data('chunkers/maxent_ne_chunker_tab', 'maxent_ne_chunker_tab')
+    else:
+        _ensure_nltk_data('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger')
+        _ensure_nltk_data('chunkers/maxent_ne_chunker', 'maxent_ne_chunker')
+    _ensure_nltk_data('corpora/words', 'words')
+
+
+_ABBREV_RE = re.compile(r'([A-Za-z])\.([A-Za-z])')
+
+
+@lru_cache(maxsize=1)
+def _get_nlp():
+    """Load the Spacy English model once, keeping only the ner (it has its own internal tok2vec)."""
+    import spacy
+    return spacy.load('en_core_web_sm', exclude=['tok2vec', 'tagger', 'parser', 'attribute_ruler', 'lemmatizer'])
+
+
+@lru_cache(maxsize=1)
+def _tagger():
+    """Load the POS tagger once, nltk.pos_tag reloads it on every call."""
+    from nltk.tag import PerceptronTagger
+    return PerceptronTagger()
+
+
+@lru_cache(maxsize=1)
+def _chunker():
+    """Load the named entity chunker once."""
+    if not _has_tab_chunker():
+        # Older NLTK releases only ship the pickled chunker
+        return nltk.data.load('chunkers/maxent_ne_chunker/english_ace_multiclass.pickle')
+    from nltk.chunk import ne_chunker
+    return ne_chunker()
 
 
 def extract_entities(
     text: str
 ) -> List[str]:
     """
-    Extracts named entities from the given text.
+    Extracts named entities from the given text using Spacy.
 
     Args:
         text (str): The input text from which named entities will be extracted.
@@ -29,14 +98,33 @@ def extract_entities(
         >>> extract_entities("Apple Inc. is a technology company.")
         ['Apple Inc.']
     """
+    return [ent.text for ent in _get_nlp()(text).ents]
+
+
+def extract_entities_nltk(
+    text: str
+) -> List[str]:
+    """
+    Extracts named entities from the given text using NLTK.
+
+    Args:
+        text (str): The input text from which named entities will be extracted.
+
+    Returns:
+        list: A list of named entities extracted from the text.
+
+    Example:
+        >>> extract_entities_nltk("Apple Inc. is a technology company.")
+        ['Apple Inc.']
+    """
     # Tokenize the text into words
     words = nltk.word_tokenize(text)
 
     # Tag the words with their part-of-speech (POS) tags
-    tagged_words = nltk.pos_tag(words)
+    tagged_words = _tagger().tag(words)
 
     # Use the named entity chunker to extract named entities
-    chunked_words = nltk.ne_chunk(tagged_words)
+    chunked_words = _chunker().parse(tagged_words)
 
     # Extract the named entities from the chunked words
     entities = []
@@ -53,6 +141,9 @@ def argparser() -> argparse.Namespace:
     parser.add_argument('--input_path', type=str, help='The file containing documents and summaries. The file must be a JSONL file (list of dictionaries) with keys "input_doc" for documents and "summary" for summaries.')
     parser.add_argument('--output_path', type=str, help='Where to save the signals. Signals are formatted as a JSONL file. Each dictionary has keys "doc_named_entities", "summary_named_entities", and "signal".')
     parser.add_argument('--lower', action='store_true', help='Whether to make entities lower cased.')
+    parser.add_argument('--engine', default='spacy', choices=['spacy', 'nltk'], help='The library used to extract the named entities.')
+    parser.add_argument('--batch_size', default=64, type=int, help='Number of texts buffered by spacy when processing them in batches. Prefer moderate values (50-100) when using many processes.')
+    parser.add_argument('--n_process', default=1, type=int, help='Number of processes used by spacy. Use -1 to use all the available CPUs.')
     return parser.parse_args()
 
 
@@ -63,12 +154,8 @@ def load_jsonl_file(
     *arguments*
     *filepath* path to the file
     """
-    data = []
     with open(filepath, "r", encoding='utf8') as f:
-        lines = f.readlines()
-        for line in lines:
-            data.append(json.loads(line.strip()))
-    return data
+        return [json.loads(line) for line in f]
 
 
 def write_jsonl_file(
@@ -89,38 +176,41 @@ def write_jsonl_file(
             os.remove(filepath)
         except:
             pass
-    with open(filepath, mode, encoding='utf8') as writer:
-        for line in input_list:
-            writer.write(json.dumps(line) + '\n')
+    with open(filepath, mode, encoding='utf8', buffering=1 << 20) as writer:
+        if input_list:
+            writer.write('\n'.join(json.dumps(line, ensure_ascii=False) for line in input_list))
+            writer.write('\n')
 
 
 def process_entity(
     entity: str
 ) -> str:
     """Postprocess the entities."""
-    pattern = r'([A-Za-z])\.([A-Za-z])'
-    matches = re.finditer(pattern, entity)
-    positions = [match.start() for match in matches]
-    positions = [x+1 for x in positions]
-    positions = [-1] + positions + [len(entity)]
-    splitted_str = []
-    for i in range(1, len(positions)):
-        pos_start = positions[i-1] + 1
-        pos_end = positions[i]
-        splitted_str.append(entity[pos_start:pos_end])
-    return '. '.join(splitted_str)
+    return _ABBREV_RE.sub(r'\1. \2', entity)
 
 
 def main(args):
     data = load_jsonl_file(args.input_path)
+
+    # Extract the entities of all the documents followed by all the summaries
+    texts = chain((row['input_doc'] for row in data), (row['summary'] for row in data))
+    if args.engine == 'spacy':
+        nlp = _get_nlp()
+        docs = nlp.pipe(texts, batch_size=args.batch_size, n_process=args.n_process)
+        entities = [[ent.text for ent in doc.ents] for doc in tqdm(docs, total=2*len(data))]
+    else:
+        download_nltk_data()
+        entities = [extract_entities_nltk(text) for text in tqdm(texts, total=2*len(data))]
+
     signals = []
-    for line in tqdm(data):
-        doc_ents = list(map(process_entity, extract_entities(line['input_doc'])))
-        summary_ents = list(map(process_entity, extract_entities(line['summary'])))
+    for doc_ents, summary_ents in zip(entities[:len(data)], entities[len(data):]):
+        doc_ents = list(map(process_entity, doc_ents))
+        summary_ents = list(map(process_entity, summary_ents))
         if args.lower:
             doc_ents = [x.lower() for x in doc_ents]
             summary_ents = [x.lower() for x in summary_ents]
-        signal = list(set(doc_ents).intersection(set(summary_ents)))
+        doc_set = set(doc_ents)
+        signal = list(set(summary_ents) & doc_set)
         signals.append({
             'doc_named_entities': doc_ents,
             'summary_named_entities': summary_ents,
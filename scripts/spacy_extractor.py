@@ -1,4 +1,4 @@
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Tuple, Callable
 import argparse
 
 from tqdm import tqdm
@@ -8,64 +8,136 @@ import os
 
 import re
 import spacy
-import copy
+from functools import lru_cache
 
 from multiprocessing import Pool
 import concurrent
 
+NOUN_TAGS = frozenset(('NN', 'NNS', 'NNP', 'NNPS'))
+# Dots between two letters, e.g. "U.S.A", which become "U. S. A"
+_ABBREV_RE = re.compile(r'(?<=[A-Za-z])\.(?=[A-Za-z])')
+
+
+@lru_cache(maxsize=1)
+def _get_nlp(
+    exclude: Tuple[str, ...] = (),
+):
+    """Load the Spacy English model once and reuse it across calls.
+    *arguments*
+    *exclude* names of the pipeline components that should not be loaded
+    """
+    return spacy.load('en_core_web_sm', exclude=list(exclude))
+
+
+def get_excluded_components(
+    kind: str,
+    filter_nouns: bool,
+) -> Tuple[str, ...]:
+    """Get the pipeline components that should not be loaded for the extraction.
+    The lemmatizer is never used, the rest are the components returned by get_unused_components.
+    *arguments*
+    *kind* either "entity" or "noun_phrase"
+    *filter_nouns* whether the entities are filtered using the POS tags
+    """
+    return ('lemmatizer',) + tuple(get_unused_components(kind, filter_nouns))
+
+
+def get_unused_components(
+    kind: str,
+    filter_nouns: bool,
+) -> List[str]:
+    """Get the pipeline components that are not needed for the extraction.
+    *arguments*
+    *kind* either "entity" or "noun_phrase"
+    *filter_nouns* whether the entities are filtered using the POS tags
+    """
+    unused = []
+    if kind == 'entity':
+        # Only the ner is queried, plus the tagger and the shared tok2vec feeding it for the noun filter.
+        # The ner has its own internal tok2vec layer
+        unused += ['parser', 'attribute_ruler']
+        if not filter_nouns:
+            unused += ['tagger', 'tok2vec']
+    elif kind == 'noun_phrase':
+        # noun_chunks needs the parser and the coarse POS set by the attribute_ruler
+        unused.append('ner')
+    return unused
+
+
+def get_span_extractor(
+    kind: str,
+) -> Callable:
+    """Get the function extracting the (text, position) pairs of the spans of a Doc.
+    *arguments*
+    *kind* either "entity" or "noun_phrase"
+    """
+    if kind == 'entity':
+        return lambda doc: [(ent.text, ent.start_char) for ent in doc.ents]
+    elif kind == 'noun_phrase':
+        return lambda doc: [(chunk.text, chunk.start_char) for chunk in doc.noun_chunks]
+    raise ValueError(f'Invalid entity type: {kind}')
+
+
+def entities_from_doc(
+    doc,
+    extractor: Callable,
+    filter_nouns: bool = False,
+) -> Tuple[List[str], List[int]]:
+    """
+    Extracts named entities from a Doc already processed by Spacy.
+
+    Args:
+        doc (Doc): The processed Spacy Doc.
+        extractor (Callable): The span extractor returned by get_span_extractor.
+        filter_nouns (bool): Whether to only keep entities containing nouns.
+
+    Returns:
+        tuple: The entities extracted from the Doc and their positions in the text.
+    """
+    # Extract the named entities and their positions from the Doc
+    spans = extractor(doc)
+    entities = [x[0] for x in spans]
+    positions = [x[1] for x in spans]
+
+    # Filter nouns
+    if filter_nouns:
+        noun_tokens = {token.text for token in doc if token.tag_ in NOUN_TAGS}
+        kept = [
+            (entity, position) for entity, position in zip(entities, positions)
+            if any(token in noun_tokens for token in entity.split())
+        ]
+        entities = [x[0] for x in kept]
+        positions = [x[1] for x in kept]
+
+    return entities, positions
+
 
 def extract_entities(
-    text: str,
     nlp,
+    text: str,
+    kind: str = 'entity',
     filter_nouns: bool = False,
-) -> List[str]:
+) -> Tuple[List[str], List[int]]:
     """
     Extracts named entities from the given text using Spacy.
 
     Args:
+        nlp: The loaded Spacy model.
         text (str): The input text from which named entities will be extracted.
+        kind (str): Either "entity" or "noun_phrase".
+        filter_nouns (bool): Whether to only keep entities containing nouns.
 
     Returns:
-        list: A list of named entities extracted from the text.
+        tuple: The named entities extracted from the text and their positions in the text.
 
     Example:
-        >>> extract_entities("Apple Inc. is a technology company.")
-        ['Apple Inc.']
+        >>> extract_entities(nlp, "Apple Inc. is a technology company.")
+        (['Apple Inc.'], [0])
     """
-    # Load the Spacy English model
-    # nlp = spacy.load('en_core_web_sm')
-
     # Create a Spacy Doc object from the text
     doc = nlp(text)
 
-    # Process the Doc with the Spacy model
-    nlp.pipeline[0][1](doc)
-
-    # Extract the named entities from the Doc
-    if args.type == 'entity':
-        entities = [ent.text for ent in doc.ents]
-    elif args.type == 'noun_phrase':
-        entities = [chunk.text for chunk in doc.noun_chunks]
-    else:
-        raise ValueError(f'Invalid entity type: {args.type}')
-
-    # Filter nouns
-    if filter_nouns:
-        ent2tag = defaultdict(list)
-        for token in doc:
-            ent2tag[token.text].append(token.tag_)
-        ent2noun = {ent: any('NN' in tag for tag in tags) for ent, tags in ent2tag.items()}
-        new_entities = []
-        for entity in entities:
-            entity_list = entity.split()
-            if any([ent2noun[token] for token in entity_list if token in ent2noun]):
-                new_entities.append(entity)
-        entities = new_entities
-
-    # Find positions of named entities from the Doc
-    positions = [text.index(x) for x in entities]
-
-    return entities, positions
+    return entities_from_doc(doc, get_span_extractor(kind), filter_nouns=filter_nouns)
 
 
 def argparser() -> argparse.Namespace:
@@ -77,6 +149,8 @@ def argparser() -> argparse.Namespace:
     parser.add_argument('--double_check', action='store_true', help='Include named entities if they are identified in the summary and manually found in the document or vice versa.')
     parser.add_argument('--nouns_only', action='store_true', help='Only keeps entities if they have nouns in the text.')
     parser.add_argument('--type', default='entity', type=str, help='Possible values are "entity" and "noun_phrase".')
+    parser.add_argument('--batch_size', default=64, type=int, help='Number of texts buffered by spacy when processing them in batches. Prefer moderate values (50-100) when using many processes.')
+    parser.add_argument('--n_process', default=1, type=int, help='Number of processes used by spacy. Use -1 to use all the available CPUs.')
     return parser.parse_args()
 
 
@@ -87,12 +161,8 @@ def load_jsonl_file(
     *arguments*
     *filepath* path to the file
     """
-    data = []
     with open(filepath, "r", encoding='utf8') as f:
-        lines = f.readlines()
-        for line in lines:
-            data.append(json.loads(line.strip()))
-    return data
+        return [json.loads(line) for line in f]
 
 
 def write_jsonl_file(
@@ -113,65 +183,82 @@ def write_jsonl_file(
             os.remove(filepath)
         except:
             pass
-    with open(filepath, mode, encoding='utf8') as writer:
-        for line in input_list:
-            writer.write(json.dumps(line) + '\n')
+    with open(filepath, mode, encoding='utf8', buffering=1 << 20) as writer:
+        if input_list:
+            writer.write('\n'.join(json.dumps(line, ensure_ascii=False) for line in input_list))
+            writer.write('\n')
 
 
 def process_entity(
     entity: str
 ) -> str:
     """Postprocess the entities."""
-    pattern = r'([A-Za-z])\.([A-Za-z])'
-    new_entity = copy.deepcopy(entity)
-    while True:
-        matches = list(re.finditer(pattern, new_entity))
-        if not matches:
-            break
-        positions = [matches[0].start(), matches[0].end()]
-        beginning = new_entity[:positions[0]]
-        end = new_entity[positions[1]:]
-        mid = new_entity[positions[0]:positions[1]].replace('.', '. ')
-        new_entity = beginning + mid + end
-
-    return new_entity
+    return _ABBREV_RE.sub('. ', entity)
 
 
 def extract_entities_from_single_document(
     line,
-    nlp,
+    doc_extraction,
+    summary_extraction,
     args,
 ):
-    doc_ents, doc_ents_positions = extract_entities(line['input_doc'], filter_nouns=args.nouns_only, nlp=nlp)
-    summary_ents, summary_ents_positions = extract_entities(line['summary'], filter_nouns=args.nouns_only, nlp=nlp)
+    doc_ents, doc_ents_positions = doc_extraction
+    summary_ents, summary_ents_positions = summary_extraction
     doc_ents = list(map(process_entity, doc_ents))
     summary_ents = list(map(process_entity, summary_ents))
     if args.lower:
         doc_ents = [x.lower() for x in doc_ents]
         summary_ents = [x.lower() for x in summary_ents]
+    doc_ents_set = set(doc_ents)
     signal = []
     signal_pos = []
+    signal_set = set()
     for _ent, _pos in zip(summary_ents, summary_ents_positions):
-        if _ent in doc_ents:
+        if _ent in doc_ents_set:
             signal.append(_ent)
             signal_pos.append(_pos)
+            signal_set.add(_ent)
     if args.double_check:
+        summary_lower = line['summary'].lower()
+        doc_lower = line['input_doc'].lower()
         for _ent, _pos in zip(doc_ents, doc_ents_positions):
-            if _ent not in signal and _ent.lower() in line['summary'].lower():
+            if _ent in signal_set:
+                continue
+            summary_pos = summary_lower.find(_ent.lower())
+            if summary_pos != -1:
                 signal.append(_ent)
-                signal_pos.append(line['summary'].lower().index(_ent.lower()))
+                signal_pos.append(summary_pos)
+                signal_set.add(_ent)
         for _ent, _pos in zip(summary_ents, summary_ents_positions):
-            if _ent not in signal and _ent.lower() in line['input_doc'].lower():
+            if _ent not in signal_set and _ent.lower() in doc_lower:
                 signal.append(_ent)
                 signal_pos.append(_pos)
+                signal_set.add(_ent)
     
-    signal = [x[0] for x in sorted(zip(signal, signal_pos), key=lambda x: x[1])]
+    order = sorted(range(len(signal)), key=signal_pos.__getitem__)
+    signal = [signal[i] for i in order]
+
+    # Drop the entities contained in other ones. An entity can only be contained in a longer one,
+    # and if it is contained in a discarded entity it is also contained in the one that discarded it.
+    # Kept entities are joined with a separator that none of the entities contains, so a single substring
+    # search over the joined string tells whether an entity is contained in any of them. This still scans
+    # all the kept entities for each candidate, but in C rather than in a Python loop
+    sep = '\x00'
+    while any(sep in ent for ent in signal_set):
+        sep = chr(ord(sep) + 1)
+    kept = []
+    kept_corpus = ''
+    for ent in sorted(signal_set, key=len, reverse=True):
+        if ent not in kept_corpus:
+            kept.append(ent)
+            kept_corpus += ent + sep
+    kept = set(kept)
 
     new_signal = []
     for ent in signal:
-        if ent not in new_signal:
-            if not any([ent in x for x in signal if ent!=x]):
-                new_signal.append(ent)
+        if ent in kept:
+            new_signal.append(ent)
+            kept.remove(ent)
 
     return {
         'doc_named_entities': doc_ents,
@@ -186,14 +273,31 @@ def split_list(input_list, x):
 
 def main(args):
     data = load_jsonl_file(args.input_path)
-    raw_signals = []
+    raw_signals = [None] * len(data)
 
-    # Load spacy
-    nlp = spacy.load('en_core_web_sm')  # We load it here because loading inside the function every time takes too much
+    # Select the spans to extract once for all the texts
+    extractor = get_span_extractor(args.type)
 
-    for line in tqdm(data):
-        signal_dict = extract_entities_from_single_document(line, nlp, args)
-        raw_signals.append(signal_dict)
+    # Load spacy
+    nlp = _get_nlp(get_excluded_components(args.type, args.nouns_only))  # We load it here because loading inside the function every time takes too much
+
+    # Process each document together with its summary in the same stream, keeping track of the row each text comes from
+    stream = (
+        (row[key], (i, key))
+        for i, row in enumerate(data)
+        for key in ('input_doc', 'summary')
+    )
+    pending = defaultdict(dict)
+    # Disable the unused components still in the pipeline. select_pipes only accepts loaded components,
+    # so the ones already excluded when loading the model are skipped
+    unused_components = get_unused_components(args.type, args.nouns_only)
+    with nlp.select_pipes(disable=[name for name in unused_components if name in nlp.pipe_names]):
+        for doc, (i, key) in tqdm(nlp.pipe(stream, as_tuples=True, batch_size=args.batch_size, n_process=args.n_process), total=2*len(data)):
+            pending[i][key] = entities_from_doc(doc, extractor, filter_nouns=args.nouns_only)
+            # Build the signal as soon as both the document and the summary are processed
+            if len(pending[i]) == 2:
+                extraction = pending.pop(i)
+                raw_signals[i] = extract_entities_from_single_document(data[i], extraction['input_doc'], extraction['summary'], args)
 
     write_jsonl_file(args.output_path, raw_signals, overwrite=True)
 